@@ -24,7 +24,7 @@ def create_assistant(client):
             "Always run the code in a Docker container until it runs without error. Use the `run_prefect_code` tool to execute Prefect code."
             "Don't give an answer unless you are able to verify your answer works by running the code in a docker container."
             "Always respond with the code example AND importantly the version of prefect that was used to run the code."
-            "If the code fails, try up to 5 times with different versions. Stop after 5 tries."
+            "If the code fails, try it with different versions by passing them all at once in `prefect_versions`; they run concurrently. Stop after 5 versions."
             "If you cannot run the code, apologize and indicate you could not verify the answer."
         ),
         tools=[run_prefect_code_tool],
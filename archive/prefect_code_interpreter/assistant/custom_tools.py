@@ -1,12 +1,40 @@
 import docker
 import os
-
-
-def create_dockerfile():
-    dockerfile_content = """
+import requests
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import urllib3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from result_cache import ExecutionResultCache, hash_text
+
+# Resource limits applied to every example container
+CONTAINER_TIMEOUT_SECONDS = 120
+CONTAINER_MEM_LIMIT = "512m"
+CONTAINER_CPUS = 1.0
+# Upper bound on images built and containers run at the same time
+MAX_CONCURRENT_RUNS = 4
+
+# Printed by the container before the example runs so the reported version is
+# the one actually installed in the image, not the one on the host.
+VERSION_MARKER = "PREFECT_VERSION="
+VERSION_PROBE = (
+    "python -c \"import prefect; print('"
+    + VERSION_MARKER
+    + "' + prefect.__version__)\""
+)
+
+result_cache = ExecutionResultCache()
+
+
+def render_dockerfile(prefect_version=None):
+    requirement = f"prefect=={prefect_version}" if prefect_version else "prefect"
+    return f"""
     FROM python:3.9-slim
 
-    RUN pip install -U prefect
+    RUN pip install -U {requirement}
 
     WORKDIR /usr/src/app
 
@@ -14,110 +42,295 @@ def create_dockerfile():
 
     CMD ["python", "example.py"]
     """
-    with open("Dockerfile", "w") as f:
-        f.write(dockerfile_content)
 
 
-def run_in_docker(example_code: str):
-    # Create Dockerfile
-    create_dockerfile()
+def create_dockerfile(path=".", prefect_version=None):
+    with open(os.path.join(path, "Dockerfile"), "w") as f:
+        f.write(render_dockerfile(prefect_version))
 
-    # Write example code to a file
-    print("Writing the following code to example.py:")
-    print(example_code)
 
-    with open("example.py", "w") as f:
-        f.write(example_code)
+def parse_library_version(logs):
+    for line in logs.splitlines():
+        if line.startswith(VERSION_MARKER):
+            return line[len(VERSION_MARKER) :].strip()
+    return None
+
+
+# Transport errors a build stream raises when its read times out or its
+# connection is closed under it
+BUILD_TIMEOUT_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ReadTimeout,
+    urllib3.exceptions.ProtocolError,
+    urllib3.exceptions.ReadTimeoutError,
+)
+
+
+def close_response(response):
+    """Close a streaming response, waking any thread blocked reading it."""
+    connection = getattr(response.raw, "connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        # Closing alone doesn't interrupt a read already waiting on the socket
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
 
-    # Check if the file was written correctly
-    with open("example.py", "r") as f:
-        written_content = f.read()
-        print("Content of example.py:")
-        print(written_content)
+def build_image(client, build_dir, tag, deadline, on_log):
+    """Build the image, giving up once `deadline` (monotonic) has passed.
 
+    Returns False if the build timed out. A timer closes the build response
+    at the deadline, even during a step that prints nothing, and
+    disconnecting from the daemon cancels the build.
+    """
+    responses = []
+    cancelled = threading.Event()
+
+    def capture_response(response, *args, **kwargs):
+        responses.append(response)
+
+    def cancel_build():
+        cancelled.set()
+        for response in responses:
+            close_response(response)
+
+    timer = threading.Timer(max(0, deadline - time.monotonic()), cancel_build)
+    timer.start()
+    client.api.hooks["response"].append(capture_response)
+    try:
+        stream = client.api.build(
+            path=build_dir,
+            tag=tag,
+            rm=True,
+            decode=True,
+            timeout=max(1, int(deadline - time.monotonic())),
+        )
+    finally:
+        client.api.hooks["response"].remove(capture_response)
+    try:
+        # The timer may have fired before the response was captured
+        if cancelled.is_set():
+            cancel_build()
+        for chunk in stream:
+            if cancelled.is_set():
+                return False
+            if "error" in chunk:
+                raise docker.errors.BuildError(chunk["error"], [])
+            line = chunk.get("stream", "").strip()
+            if line:
+                on_log(line)
+        return not cancelled.is_set()
+    except Exception as e:
+        if cancelled.is_set() or isinstance(e, BUILD_TIMEOUT_ERRORS):
+            return False
+        raise
+    finally:
+        timer.cancel()
+        for response in responses:
+            response.close()
+
+
+def run_in_docker(
+    example_code: str,
+    prefect_version=None,
+    timeout=CONTAINER_TIMEOUT_SECONDS,
+    mem_limit=CONTAINER_MEM_LIMIT,
+    cpus=CONTAINER_CPUS,
+    on_log=None,
+    use_cache=True,
+):
+    """Build an image for the given Prefect version and run the example in it.
+
+    Logs are streamed to `on_log` line by line as the container produces them.
+    The build and the run together get `timeout` seconds; the build is
+    cancelled or the container killed once it has passed. Finished runs are
+    cached by code and image; pass `use_cache=False` for nondeterministic
+    code.
+    """
+    label = prefect_version or "latest"
+    tag = f"example_image:prefect-{label}"
+    on_log = on_log or (lambda line: print(f"[prefect {label}] {line}"))
+
+    image_digest = hash_text(render_dockerfile(prefect_version))
+    if use_cache:
+        cached = result_cache.get(example_code, image_digest)
+        if cached is not None:
+            print(f"Using cached result for {tag}")
+            return {**cached, "cached": True}
+
+    # Every run gets its own build context so concurrent builds don't clobber
+    # each other's Dockerfile and example.py
+    build_dir = tempfile.mkdtemp(prefix=f"prefect-{label}-")
+    create_dockerfile(build_dir, prefect_version)
+    with open(os.path.join(build_dir, "example.py"), "w") as f:
+        f.write(example_code)
+
+    start = time.monotonic()
+    deadline = start + timeout
+    container = None
     try:
         # Set Docker environment variable
         os.environ["DOCKER_HOST"] = "unix:///var/run/docker.sock"
 
-        # Reinitialize Docker client after setting environment variable
         client = docker.from_env()
 
-        # Build the Docker image
-        print("Building Docker image...")
-        image, logs = client.images.build(path=".", tag="example_image")
-        for log in logs:
-            stream = log.get("stream")
-            if stream:
-                print(stream.strip())
-
-        # Run the Docker container
-        print("Running Docker container...")
-        container = client.containers.run(image="example_image", detach=True)
-
-        # Wait for the container to finish
-        print("Waiting for container to finish...")
-        result = container.wait()
-        print(f"Container finished with status: {result['StatusCode']}")
-
-        # Capture container logs
-        print("Capturing container logs...")
-        logs = container.logs(stdout=True, stderr=True).decode("utf-8")
-        print("Container logs captured successfully.")
-        print("Container logs:\n", logs)
-
-        container.remove()
-        return logs
-    except docker.errors.APIError as e:
-        print(f"API error: {e}")
-        return f"API error: {e}"
+        print(f"Building Docker image {tag}...")
+        if not build_image(client, build_dir, tag, deadline, on_log):
+            print(f"Build of {tag} timed out")
+            return {
+                "requested_version": prefect_version,
+                "timed_out": True,
+                "error": f"Build timed out after {timeout}s",
+            }
+        image = client.images.get(tag)
+
+        print(f"Running Docker container for {tag}...")
+        container = client.containers.run(
+            image=tag,
+            command=["sh", "-c", f"{VERSION_PROBE} && python example.py"],
+            detach=True,
+            mem_limit=mem_limit,
+            nano_cpus=int(cpus * 1e9),
+        )
+
+        timed_out = threading.Event()
+
+        def kill_container():
+            timed_out.set()
+            try:
+                container.kill()
+            except docker.errors.APIError:
+                pass
+
+        timer = threading.Timer(max(0, deadline - time.monotonic()), kill_container)
+        timer.start()
+        try:
+            lines = []
+            buffer = ""
+            for chunk in container.logs(
+                stdout=True, stderr=True, stream=True, follow=True
+            ):
+                buffer += chunk.decode("utf-8", errors="replace")
+                *complete, buffer = buffer.split("\n")
+                for line in complete:
+                    lines.append(line)
+                    on_log(line)
+            if buffer:
+                lines.append(buffer)
+                on_log(buffer)
+            result = container.wait()
+        finally:
+            timer.cancel()
+
+        logs = "\n".join(lines)
+        run = {
+            "requested_version": prefect_version,
+            "library_version": parse_library_version(logs),
+            "image_id": image.id,
+            "status_code": result["StatusCode"],
+            "timed_out": timed_out.is_set(),
+            "logs": logs,
+            "duration": round(time.monotonic() - start, 2),
+            "cached": False,
+        }
+        # Timeouts and infrastructure errors are not cached, only real
+        # results, and nothing is cached for code marked as nondeterministic
+        if use_cache and not run["timed_out"]:
+            result_cache.set(example_code, image_digest, run)
+        return run
     except docker.errors.BuildError as e:
         print(f"Build error: {e}")
-        return f"Build error: {e}"
+        return {"requested_version": prefect_version, "error": f"Build error: {e}"}
     except docker.errors.ContainerError as e:
         print(f"Container error: {e}")
-        return f"Container error: {e}"
+        return {"requested_version": prefect_version, "error": f"Container error: {e}"}
+    except docker.errors.APIError as e:
+        print(f"API error: {e}")
+        return {"requested_version": prefect_version, "error": f"API error: {e}"}
     except Exception as e:
         print(f"Unexpected error: {e}")
-        return f"Unexpected error: {e}"
+        return {"requested_version": prefect_version, "error": f"Unexpected error: {e}"}
+    finally:
+        if container is not None:
+            try:
+                container.remove(force=True)
+            except docker.errors.APIError:
+                pass
+        shutil.rmtree(build_dir, ignore_errors=True)
 
 
-def execute_example_in_docker(example_code):
+def execute_example_in_docker(example_code, prefect_version=None, use_cache=True):
     try:
-        # Run example code in Docker
-        result = run_in_docker(example_code)
-        # Get library version
-        version_command = "pip show prefect | grep Version"
-        version_result = os.popen(version_command).read().strip()
+        run = run_in_docker(example_code, prefect_version, use_cache=use_cache)
+        if run.get("error"):
+            return {"error": run["error"]}
+        if run["timed_out"]:
+            return {"error": f"Timed out after {CONTAINER_TIMEOUT_SECONDS}s"}
         return {
             "example_code": example_code,
-            "result": result,
-            "library_version": version_result,
+            "result": run["logs"],
+            "status_code": run["status_code"],
+            "library_version": run["library_version"],
+            "cached": run["cached"],
         }
     except Exception as e:
         return {"error": str(e)}
 
 
+def run_prefect_code_versions(example_code, prefect_versions, use_cache=True):
+    """Run the example against several Prefect versions at once.
+
+    Each version is built and run in its own container, up to
+    MAX_CONCURRENT_RUNS at a time, so a probe of a few versions takes as long
+    as the slowest one rather than the sum of all of them.
+    """
+    runs = []
+    max_workers = min(len(prefect_versions), MAX_CONCURRENT_RUNS)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(run_in_docker, example_code, version, use_cache=use_cache)
+            for version in prefect_versions
+        ]
+        for future in as_completed(futures):
+            run = future.result()
+            runs.append(run)
+            print(
+                f"Prefect {run['requested_version']} finished: "
+                f"{run.get('error') or run['status_code']}"
+            )
+
+    # Report in the order the versions were requested
+    runs.sort(key=lambda run: prefect_versions.index(run["requested_version"]))
+    return {
+        "example_code": example_code,
+        "runs": runs,
+        "working_versions": [
+            run["library_version"]
+            for run in runs
+            if not run.get("error") and not run["timed_out"] and run["status_code"] == 0
+        ],
+    }
+
+
 def run_prefect_code(params):
     example_code = params.get("example_code")
+    prefect_versions = params.get("prefect_versions")
+    use_cache = not params.get("bypass_cache", False)
     print("This is Params: ", params)
     print("This is example_code: ", example_code)
     if not example_code:
         return {"error": "No code provided"}
 
-    retries = 5
-    for attempt in range(retries):
-        result = execute_example_in_docker(example_code)
-        if not result.get("error"):
-            return result
-        example_code = update_example_code(example_code, attempt + 1)
-
-    return {"error": "Failed to run the code successfully after 5 attempts"}
+    if prefect_versions:
+        return run_prefect_code_versions(example_code, prefect_versions, use_cache)
 
-
-def update_example_code(example_code, attempt):
-    # Modify the example code based on the attempt number
-    # This is a placeholder function; you'll need to implement the logic to modify the code.
-    return example_code
+    # Rerunning the same code against the same image gives the same result, so
+    # there is a single attempt; trying other versions goes through
+    # prefect_versions instead
+    return execute_example_in_docker(example_code, use_cache=use_cache)
 
 
 run_prefect_code_tool = {
@@ -132,6 +345,15 @@ run_prefect_code_tool = {
                     "type": "string",
                     "description": "The Prefect code to run",
                 },
+                "prefect_versions": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Prefect versions to run the code against concurrently, e.g. ['2.19.9', '3.0.0']",
+                },
+                "bypass_cache": {
+                    "type": "boolean",
+                    "description": "Always run the code instead of reusing a cached result. Set this for nondeterministic code (random values, current time, network calls).",
+                },
             },
             "required": ["example_code"],
         },
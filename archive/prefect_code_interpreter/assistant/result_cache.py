@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(__file__), ".execution_cache.db")
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 500
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ExecutionResultCache:
+    """Persistent cache of container runs keyed by (code hash, image digest).
+
+    Entries expire after `ttl_seconds`. Once more than `max_entries` are
+    stored, the least recently used ones are evicted.
+    """
+
+    def __init__(
+        self,
+        path=DEFAULT_CACHE_PATH,
+        ttl_seconds=DEFAULT_TTL_SECONDS,
+        max_entries=DEFAULT_MAX_ENTRIES,
+    ):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    code_hash TEXT NOT NULL,
+                    image_digest TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL,
+                    PRIMARY KEY (code_hash, image_digest)
+                )
+                """)
+
+    @contextmanager
+    def _connect(self):
+        # A fresh connection per call keeps the cache safe to use from the
+        # threads that run several versions at once
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, code, image_digest):
+        now = time.time()
+        key = (hash_text(code), image_digest)
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT result, created_at FROM results "
+                "WHERE code_hash = ? AND image_digest = ?",
+                key,
+            ).fetchone()
+            if row is None:
+                return None
+            result, created_at = row
+            if now - created_at > self.ttl_seconds:
+                conn.execute(
+                    "DELETE FROM results WHERE code_hash = ? AND image_digest = ?",
+                    key,
+                )
+                return None
+            conn.execute(
+                "UPDATE results SET last_used_at = ? "
+                "WHERE code_hash = ? AND image_digest = ?",
+                (now, *key),
+            )
+        return json.loads(result)
+
+    def set(self, code, image_digest, result):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                (hash_text(code), image_digest, json.dumps(result), now, now),
+            )
+            conn.execute(
+                "DELETE FROM results WHERE created_at < ?",
+                (now - self.ttl_seconds,),
+            )
+            conn.execute(
+                """
+                DELETE FROM results WHERE rowid NOT IN (
+                    SELECT rowid FROM results ORDER BY last_used_at DESC LIMIT ?
+                )
+                """,
+                (self.max_entries,),
+            )
@@ -1,16 +1,19 @@
 import os
-from openai import OpenAI
+import sys
 from dotenv import load_dotenv
 from tools import query_tech_news
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.openai_clients import get_openai_client
+
 # Load environment variables from .env file
 load_dotenv()
 
 # Get the API key from environment variables
 api_key = os.getenv("OPENAI_API_KEY")
 
-# Create an OpenAI client
-client = OpenAI(api_key=api_key)
+# Create an OpenAI client on the shared connection pool
+client = get_openai_client(api_key)
 
 # Create the assistant with the custom tool
 analyst_assistant = client.beta.assistants.create(
@@ -41,6 +44,14 @@ analyst_assistant = client.beta.assistants.create(
                             "type": "integer",
                             "description": "The number of results to return (default: 5)",
                         },
+                        "start_date": {
+                            "type": "string",
+                            "description": "Only return articles published on or after this date (YYYY-MM-DD)",
+                        },
+                        "end_date": {
+                            "type": "string",
+                            "description": "Only return articles published on or before this date (YYYY-MM-DD)",
+                        },
                     },
                     "required": ["query"],
                 },
@@ -0,0 +1,126 @@
+import calendar
+import json
+import re
+from concurrent.futures import wait
+
+# Company names the analyst bot is commonly asked about, searched alongside
+# their ticker symbols
+COMPANY_TICKERS = {
+    "alphabet": "GOOGL",
+    "amazon": "AMZN",
+    "apple": "AAPL",
+    "google": "GOOGL",
+    "meta": "META",
+    "microsoft": "MSFT",
+    "netflix": "NFLX",
+    "nvidia": "NVDA",
+    "tesla": "TSLA",
+}
+
+# Upper-case words that look like tickers but aren't
+NON_TICKERS = {"AI", "CEO", "CFO", "EPS", "ETF", "I", "IPO", "OK", "US", "USA"}
+
+# Capitalized words that are never worth a news search of their own
+NOT_NAMES = (
+    set(calendar.day_name)
+    | set(calendar.day_abbr)
+    | set(calendar.month_name[1:])
+    | set(calendar.month_abbr[1:])
+    | {"Dr", "Mr", "Mrs", "Ms", "Please", "The", "This", "Today", "Tomorrow"}
+)
+
+MAX_PREFETCH_QUERIES = 4
+
+
+def derive_prefetch_queries(messages, max_queries=MAX_PREFETCH_QUERIES) -> list:
+    """Guess the news searches the model is likely to make for these messages.
+
+    Picks out ticker symbols such as $AAPL or AAPL, and runs of capitalized
+    words such as "New York Times" as one name, skipping the first word of
+    each sentence unless it is a known company. Known companies and tickers
+    come before other names, since they are what the analyst is asked about.
+    """
+    companies = []
+    names = []
+
+    def add(queries, query):
+        seen = [q.lower() for q in companies + names]
+        if query.lower() not in seen:
+            queries.append(query)
+
+    for message in messages:
+        for ticker in re.findall(r"\$([A-Z]{1,5})\b", message):
+            add(companies, ticker)
+        for sentence in re.split(r"[.!?]\s+", message):
+            words = [
+                re.sub(r"'s$", "", word).rstrip(".")
+                for word in re.findall(r"[A-Za-z][\w&.'-]*", sentence)
+            ]
+            run = []
+            for i, word in enumerate(words + [""]):
+                is_name = (
+                    word[:1].isupper()
+                    and not word.isupper()
+                    and word not in NOT_NAMES
+                    and (i > 0 or word.lower() in COMPANY_TICKERS)
+                )
+                if is_name:
+                    run.append(word)
+                    continue
+                if run:
+                    name = " ".join(run)
+                    ticker = COMPANY_TICKERS.get(name.lower())
+                    if ticker:
+                        add(companies, name)
+                        add(companies, ticker)
+                    else:
+                        add(names, name)
+                    run = []
+                if word.isupper() and word not in NON_TICKERS and len(word) <= 5:
+                    add(companies, word)
+    return (companies + names)[:max_queries]
+
+
+def prefetch_news(memo, messages) -> dict:
+    """Start news searches for the likely queries in the background.
+
+    The searches run on the memo's low-priority prefetch pool. When the model
+    later makes the same call it is answered from the prefetched result.
+    Returns the futures keyed by query.
+    """
+    return {
+        query: memo.prefetch("query_tech_news", {"query": query})
+        for query in derive_prefetch_queries(messages)
+    }
+
+
+def prefetched_news_context(prefetches: dict, timeout: float = 0) -> str:
+    """Format the prefetched searches that finish within `timeout` seconds.
+
+    The result is passed to the run as additional instructions, so the model
+    can use the articles directly however it would have phrased its search.
+    Searches that fail or are still running are left out; by default nothing
+    is waited for.
+    """
+    done, _ = wait(prefetches.values(), timeout=timeout)
+    sections = []
+    # A company and its ticker mostly find the same articles
+    seen = set()
+    for query, future in prefetches.items():
+        if future not in done or future.exception() is not None:
+            continue
+        articles = [
+            article
+            for article in json.loads(future.result())
+            if article["article"] not in seen
+        ]
+        seen.update(article["article"] for article in articles)
+        if articles:
+            sections.append(f"News about {query}:\n{json.dumps(articles)}")
+    if not sections:
+        return ""
+    return (
+        "Recent news articles have already been retrieved for the companies "
+        "the user mentioned. Use them before calling query_tech_news, and only "
+        "search again for anything they don't cover.\n\n" + "\n\n".join(sections)
+    )
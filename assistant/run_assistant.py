@@ -1,31 +1,45 @@
 from create_assistant import analyst_assistant
 from prefect.task_runners import ThreadPoolTaskRunner
-from openai import OpenAI
 from dotenv import load_dotenv
+import httpx
 import os
+import sys
+import threading
 from typing_extensions import override
-from openai import AssistantEventHandler
+from openai import APITimeoutError, AssistantEventHandler
 from prefect import task, flow
-from tools import query_tech_news
-import json
+from tool_calls import ToolCallMemo
+from prefetch import MAX_PREFETCH_QUERIES, prefetch_news, prefetched_news_context
 import time
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.deadline import Deadline, DeadlineExceeded, deadline_scope
+from common.openai_clients import get_openai_client
+
+# Latency budget for one assistant turn, from creating the run to the reply
+TURN_BUDGET_SECONDS = 60
+# Cancelling a timed-out run is allowed a little time past the budget
+CANCEL_TIMEOUT_SECONDS = 5
+# Runs in these states are finished and can't be cancelled
+TERMINAL_RUN_STATUSES = ["completed", "failed", "cancelled", "expired"]
+
+USER_MESSAGES = [
+    "Can you predict if Apple's stock price will increase tomorrow?",
+    "Please gather the latest news articles related to Apple and analyze if this news will likely have a positive or negative effect on the stock price.",
+]
+
 
 def load_and_get_client():
-    """Load environment variables and create an OpenAI client."""
+    """Load environment variables and get the shared OpenAI client."""
     load_dotenv()
     api_key = os.getenv("OPENAI_API_KEY")
-    return OpenAI(api_key=api_key)
+    return get_openai_client(api_key)
 
 
 def create_thread_with_messages(client):
     """Create a thread and add initial messages."""
     thread = client.beta.threads.create()
-    messages = [
-        "Can you predict if Apple's stock price will increase tomorrow?",
-        "Please gather the latest news articles related to Apple and analyze if this news will likely have a positive or negative effect on the stock price.",
-    ]
-    for message in messages:
+    for message in USER_MESSAGES:
         client.beta.threads.messages.create(
             thread_id=thread.id,
             role="user",
@@ -35,6 +49,16 @@ def create_thread_with_messages(client):
 
 
 class EventHandler(AssistantEventHandler):
+    def __init__(self, deadline=None):
+        super().__init__()
+        self.deadline = deadline
+
+    @override
+    def on_event(self, event) -> None:
+        # Stop consuming the stream once the turn is out of time
+        if self.deadline is not None:
+            self.deadline.check("Streaming the run")
+
     @override
     def on_text_created(self, text) -> None:
         print(f"\nassistant > Text created", flush=True)
@@ -57,13 +81,13 @@ class EventHandler(AssistantEventHandler):
                     if output.type == "logs":
                         print(f"\n{output.logs}", flush=True)
         elif delta.type == "function":
-            if delta.function.name == "query_tech_news":
+            # Arguments arrive in fragments; tools only run once the run
+            # reaches requires_action with the complete call
+            if delta.function.arguments:
                 print(
-                    f"Calling query_tech_news with arguments: {delta.function.arguments}",
+                    f"Function arguments: {delta.function.arguments}",
                     flush=True,
                 )
-                result = query_tech_news(**json.loads(delta.function.arguments))
-                print(f"query_tech_news result: {result}", flush=True)
 
     def on_exception(self, exception):
         print(f"Exception in event handler: {exception}", flush=True)
@@ -72,70 +96,196 @@ class EventHandler(AssistantEventHandler):
         print("Event stream ended", flush=True)
 
 
-# TODO this still isn't working
-def run_assistant_with_event_handler(client, thread_id):
-    """Run the assistant with event handling."""
+def grace_deadline(deadline, seconds):
+    """Return the turn's deadline, extended to at least `seconds` from now."""
+    return Deadline(max(deadline.remaining(), seconds))
+
+
+def cancel_run(client, thread_id, run_id):
+    """Cancel a run, without letting a failure mask the original timeout."""
     try:
-        print(f"Starting assistant run for thread {thread_id}")
+        # Cancelling gets its own budget, since the turn's is usually spent
+        with deadline_scope(Deadline(CANCEL_TIMEOUT_SECONDS)):
+            client.beta.threads.runs.cancel(
+                thread_id=thread_id, run_id=run_id, timeout=CANCEL_TIMEOUT_SECONDS
+            )
+        print(f"Cancelled run {run_id}")
+    except Exception as e:
+        print(f"Failed to cancel run {run_id}: {e}")
 
-        run = client.beta.threads.runs.create(
-            thread_id=thread_id,
-            assistant_id=analyst_assistant.id,
-            instructions="Please address the user as Jane Doe. Use the query_tech_news function to find relevant articles when needed.",
-        )
-        print(f"Run created with ID: {run.id}")
-
-        while True:
-            run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-            print(f"Run status: {run.status}")
-
-            if run.status == "completed":
-                print("Run completed successfully")
-                break
-            elif run.status == "requires_action":
-                print("Run requires action")
-                tool_calls = run.required_action.submit_tool_outputs.tool_calls
-                tool_outputs = []
-                for tool_call in tool_calls:
-                    function_name = tool_call.function.name
-                    function_args = json.loads(tool_call.function.arguments)
-                    if function_name == "query_tech_news":
-                        output = query_tech_news(**function_args)
-                        tool_outputs.append(
-                            {
-                                "tool_call_id": tool_call.id,
-                                "output": output,
-                            }
+
+def stream_until_deadline(client, thread_id, stream, deadline):
+    """Consume a run stream, returning False if it ran past the deadline.
+
+    The stream's own timeout only limits each read, so a timer cancels the
+    streamed run at the deadline, which ends the stream, or closes the stream
+    if no run has started yet. A run still going after a read timeout or a
+    missed deadline is cancelled too.
+    """
+    stopped = threading.Event()
+
+    def stop_stream():
+        stopped.set()
+        if stream.current_run is not None:
+            cancel_run(client, thread_id, stream.current_run.id)
+        else:
+            stream.close()
+
+    timer = threading.Timer(deadline.remaining(), stop_stream)
+    timer.start()
+    try:
+        stream.until_done()
+        return not stopped.is_set()
+    except (DeadlineExceeded, APITimeoutError, httpx.TimeoutException):
+        pass
+    except Exception:
+        # Closing the stream under the reader surfaces as a transport error
+        if not stopped.is_set():
+            raise
+    finally:
+        timer.cancel()
+    if not stopped.is_set() and stream.current_run is not None:
+        cancel_run(client, thread_id, stream.current_run.id)
+    return False
+
+
+def timeout_result(deadline, thread_id, run_id, run_status):
+    return {
+        "status": "timeout",
+        "thread_id": thread_id,
+        "run_id": run_id,
+        "run_status": run_status,
+        "budget_seconds": deadline.budget_seconds,
+        "elapsed_seconds": round(deadline.elapsed(), 2),
+    }
+
+
+# TODO this still isn't working
+def run_assistant_with_event_handler(
+    client,
+    thread_id,
+    prefetch_messages=None,
+    budget_seconds=TURN_BUDGET_SECONDS,
+):
+    """Run the assistant with event handling.
+
+    If `prefetch_messages` is given, news searches for the companies and
+    tickers they mention start in the background. The run is created without
+    waiting for them; any already finished are passed along as additional
+    instructions, and the rest answer the model's matching tool calls.
+
+    The whole turn has to finish within `budget_seconds`. The deadline is
+    passed down to API requests, tool calls and embedding calls. When it
+    runs out the run is cancelled, finished tool outputs are still submitted,
+    and a result with status "timeout" is returned.
+    """
+    deadline = Deadline(budget_seconds)
+    # Each request is sent once with whatever time is left, since the
+    # client's automatic retries would each start a fresh timeout
+    client = client.with_options(max_retries=0)
+    # Identical tool calls are executed once for the whole run. Prefetches
+    # run side by side so their query embeddings share a batch.
+    memo = ToolCallMemo(prefetch_workers=MAX_PREFETCH_QUERIES)
+    run = None
+    # Everything in the turn, including tool threads and the rate limiter's
+    # waits, sees the deadline
+    with deadline_scope(deadline):
+        try:
+            print(f"Starting assistant run for thread {thread_id}")
+
+            prefetched_context = None
+            if prefetch_messages:
+                prefetches = prefetch_news(memo, prefetch_messages)
+                print(f"Prefetching news for: {list(prefetches)}")
+                prefetched_context = prefetched_news_context(prefetches)
+
+            run = client.beta.threads.runs.create(
+                thread_id=thread_id,
+                assistant_id=analyst_assistant.id,
+                instructions="Please address the user as Jane Doe. Use the query_tech_news function to find relevant articles when needed.",
+                additional_instructions=prefetched_context or None,
+                timeout=deadline.remaining(),
+            )
+            print(f"Run created with ID: {run.id}")
+
+            while True:
+                if deadline.expired:
+                    print(f"Run {run.id} exceeded its {budget_seconds}s budget")
+                    cancel_run(client, thread_id, run.id)
+                    return timeout_result(deadline, thread_id, run.id, run.status)
+
+                run = client.beta.threads.runs.retrieve(
+                    thread_id=thread_id, run_id=run.id, timeout=deadline.remaining()
+                )
+                print(f"Run status: {run.status}")
+
+                if run.status == "completed":
+                    print("Run completed successfully")
+                    break
+                elif run.status == "requires_action":
+                    print("Run requires action")
+                    tool_calls = run.required_action.submit_tool_outputs.tool_calls
+                    tool_outputs = memo.run_tool_calls(
+                        tool_calls, timeout=deadline.remaining()
+                    )
+                    # Submitted even when some calls timed out, so the finished
+                    # results aren't lost
+                    with deadline_scope(
+                        grace_deadline(deadline, CANCEL_TIMEOUT_SECONDS)
+                    ):
+                        client.beta.threads.runs.submit_tool_outputs(
+                            thread_id=thread_id,
+                            run_id=run.id,
+                            tool_outputs=tool_outputs,
+                            timeout=max(deadline.remaining(), CANCEL_TIMEOUT_SECONDS),
                         )
-                client.beta.threads.runs.submit_tool_outputs(
-                    thread_id=thread_id, run_id=run.id, tool_outputs=tool_outputs
+                elif run.status in TERMINAL_RUN_STATUSES:
+                    print(f"Run ended with status: {run.status}")
+                    break
+                else:
+                    # Wait for 1 second before checking again
+                    time.sleep(min(1, deadline.remaining()))
+
+            print("Run completed, now streaming results")
+
+            # Now that the run is complete, we can stream the results
+            with client.beta.threads.runs.stream(
+                thread_id=thread_id,
+                assistant_id=analyst_assistant.id,
+                event_handler=EventHandler(deadline),
+                timeout=deadline.remaining(),
+            ) as stream:
+                print("Streaming started")
+                if not stream_until_deadline(client, thread_id, stream, deadline):
+                    print(f"Streaming exceeded the {budget_seconds}s budget")
+                    streamed_run = stream.current_run or run
+                    return timeout_result(
+                        deadline, thread_id, streamed_run.id, streamed_run.status
+                    )
+
+            print("Streaming completed")
+
+            # Fetch and print the messages after the run
+            with deadline_scope(grace_deadline(deadline, 1)):
+                messages = client.beta.threads.messages.list(
+                    thread_id=thread_id, timeout=max(deadline.remaining(), 1)
                 )
-            elif run.status in ["failed", "cancelled", "expired"]:
-                print(f"Run ended with status: {run.status}")
-                break
-            else:
-                time.sleep(1)  # Wait for 1 second before checking again
-
-        print("Run completed, now streaming results")
-
-        # Now that the run is complete, we can stream the results
-        with client.beta.threads.runs.stream(
-            thread_id=thread_id,
-            assistant_id=analyst_assistant.id,
-            event_handler=EventHandler(),
-        ) as stream:
-            print("Streaming started")
-            stream.until_done()
-
-        print("Streaming completed")
-
-        # Fetch and print the messages after the run
-        messages = client.beta.threads.messages.list(thread_id=thread_id)
-        for message in messages:
-            print(f"Message: {message.role} - {message.content[0].text.value}")
+            for message in messages:
+                print(f"Message: {message.role} - {message.content[0].text.value}")
+            return {"status": run.status, "thread_id": thread_id, "run_id": run.id}
 
-    except Exception as e:
-        print(f"Error in run_assistant_with_event_handler: {e}")
+        except APITimeoutError as e:
+            print(f"Request timed out in run_assistant_with_event_handler: {e}")
+            if run is not None and run.status not in TERMINAL_RUN_STATUSES:
+                cancel_run(client, thread_id, run.id)
+            return timeout_result(
+                deadline, thread_id, run and run.id, run and run.status
+            )
+        except Exception as e:
+            print(f"Error in run_assistant_with_event_handler: {e}")
+            return {"status": "error", "thread_id": thread_id, "error": str(e)}
+        finally:
+            memo.close()
 
 
 def main():
@@ -145,8 +295,10 @@ def main():
         print("Client created")
         thread_id = create_thread_with_messages(client)
         print(f"Thread created with ID: {thread_id}")
-        run_assistant_with_event_handler(client, thread_id)
-        print("Assistant run completed")
+        result = run_assistant_with_event_handler(
+            client, thread_id, prefetch_messages=USER_MESSAGES
+        )
+        print(f"Assistant run completed: {result}")
     except Exception as e:
         print(f"An error occurred in main: {e}")
 
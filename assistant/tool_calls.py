@@ -0,0 +1,153 @@
+import contextvars
+import json
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from tools import query_tech_news
+
+TOOL_FUNCTIONS = {"query_tech_news": query_tech_news}
+
+# Defaults filled in before comparing calls, so omitting an argument and
+# passing its default value count as the same call
+TOOL_DEFAULTS = {
+    "query_tech_news": {"num_results": 5, "start_date": None, "end_date": None}
+}
+
+# Words the model pads search queries with that don't change what is retrieved
+QUERY_FILLER_WORDS = {
+    "a",
+    "about",
+    "an",
+    "article",
+    "articles",
+    "latest",
+    "news",
+    "on",
+    "recent",
+    "regarding",
+    "related",
+    "the",
+    "to",
+}
+
+
+def canonical_query(query: str) -> str:
+    words = re.findall(r"[\w$.&-]+", query.lower())
+    return " ".join(word for word in words if word not in QUERY_FILLER_WORDS)
+
+
+def tool_call_key(function_name: str, arguments: dict) -> str:
+    """Key a tool call by its function name and canonicalized arguments."""
+    canonical = {**TOOL_DEFAULTS.get(function_name, {}), **arguments}
+    if "query" in canonical:
+        canonical["query"] = canonical_query(canonical["query"])
+    return json.dumps([function_name, canonical], sort_keys=True)
+
+
+def error_output(message: str) -> Future:
+    """Return an already finished future whose tool output is an error."""
+    future = Future()
+    future.set_result(json.dumps({"error": message}))
+    return future
+
+
+class ToolCallMemo:
+    """Run each distinct tool call once per assistant run.
+
+    Calls are keyed by function name and canonicalized arguments, so duplicate
+    calls within one requires_action batch, and repeats in later steps of the
+    same run, share a single execution.
+    """
+
+    def __init__(self, max_workers: int = 4, prefetch_workers: int = 1):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Speculative calls get their own small pool so they never hold up
+        # calls the model actually made
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=prefetch_workers)
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def submit(self, function_name: str, arguments: dict):
+        """Return the future for a call, starting it only if it is new."""
+        return self._submit(self.executor, function_name, arguments)
+
+    def prefetch(self, function_name: str, arguments: dict):
+        """Start a call the model is likely to make, at a lower priority."""
+        return self._submit(self.prefetch_executor, function_name, arguments)
+
+    def _submit(self, executor, function_name: str, arguments: dict, key=None):
+        key = key or tool_call_key(function_name, arguments)
+        with self.lock:
+            future = self.futures.get(key)
+            if future is not None:
+                return future
+            # Run in a copy of the caller's context so the tool sees the
+            # turn's deadline
+            context = contextvars.copy_context()
+            future = executor.submit(
+                context.run, TOOL_FUNCTIONS[function_name], **arguments
+            )
+            self.futures[key] = future
+        # Added outside the lock, since it runs right away if the call is
+        # already done
+        future.add_done_callback(lambda future: self._forget_failure(key, future))
+        return future
+
+    def _forget_failure(self, key: str, future):
+        """Drop a failed call, so a later identical call runs it again."""
+        if not future.cancelled() and future.exception() is None:
+            return
+        with self.lock:
+            if self.futures.get(key) is future:
+                del self.futures[key]
+
+    def run_tool_calls(self, tool_calls, timeout=None) -> list:
+        """Execute a requires_action batch and return its tool outputs.
+
+        Calls still running after `timeout` seconds get a timeout error as
+        their output, so the finished ones can still be submitted.
+        """
+        expires_at = None if timeout is None else time.monotonic() + timeout
+        futures = []
+        for tool_call in tool_calls:
+            function_name = tool_call.function.name
+            if function_name not in TOOL_FUNCTIONS:
+                futures.append((tool_call.id, error_output("Unknown function")))
+                continue
+            # The model occasionally emits truncated, non-object or mistyped
+            # arguments; answer those with an error instead of failing the
+            # whole batch
+            try:
+                arguments = json.loads(tool_call.function.arguments or "{}")
+                key = tool_call_key(function_name, arguments)
+            except (AttributeError, TypeError, ValueError):
+                futures.append((tool_call.id, error_output("Invalid arguments")))
+                continue
+            futures.append(
+                (
+                    tool_call.id,
+                    self._submit(self.executor, function_name, arguments, key),
+                )
+            )
+
+        tool_outputs = []
+        for tool_call_id, future in futures:
+            try:
+                output = future.result(
+                    timeout=(
+                        None
+                        if expires_at is None
+                        else max(0, expires_at - time.monotonic())
+                    )
+                )
+            except TimeoutError:
+                output = json.dumps({"error": "timeout"})
+            except Exception as e:
+                output = json.dumps({"error": str(e)})
+            tool_outputs.append({"tool_call_id": tool_call_id, "output": output})
+        return tool_outputs
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.prefetch_executor.shutdown(wait=False, cancel_futures=True)
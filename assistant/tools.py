@@ -1,32 +1,142 @@
 # tools.py
 import chromadb
-import chromadb.utils.embedding_functions as embedding_functions
 import os
+import sys
 import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.deadline import current_deadline
+from common.embedding_coalescer import get_coalesced_embedding_function
+from common.embedding_config import EmbeddingConfig, check_collection_config
+from common.news_index import (
+    list_partitions,
+    parse_published_at,
+    partitions_in_window,
+    resolve_collection_name,
+)
 
 
 class ChromaNewsDatabase:
-    def __init__(self):
+    def __init__(self, embedding_config=None):
         self.openai_api_key = os.getenv("OPENAI_API_KEY")
-        self.embedding_model_name = "text-embedding-ada-002"
         self.chroma_db_path = "./chroma_db"
 
         self.chroma_client = chromadb.PersistentClient(path=self.chroma_db_path)
-        self.openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-            api_key=self.openai_api_key, model_name=self.embedding_model_name
+        # The alias is resolved on every instantiation so queries follow a
+        # reindex as soon as it switches collections
+        base_name = resolve_collection_name(self.chroma_db_path)
+        self.partitions = list_partitions(self.chroma_client, base_name)
+        if not self.partitions:
+            raise ValueError(f"No news collections found for {base_name}")
+        # Queries are embedded with the model and dimensions recorded on the
+        # collections, so they can never be compared against mismatched
+        # vectors. A caller that needs a specific config is refused if it
+        # doesn't match.
+        collection = self.chroma_client.get_collection(
+            next(iter(self.partitions.values()))
+        )
+        self.embedding_config = embedding_config or (
+            EmbeddingConfig.from_collection_metadata(collection.metadata)
+        )
+        # Shared by every query in the process, so concurrent queries are
+        # embedded together in one request
+        self.openai_ef = get_coalesced_embedding_function(
+            self.embedding_config, self.openai_api_key
+        )
+
+    def query_partition(
+        self, collection_name, query_embeddings, n_results, where, deadline=None
+    ):
+        if deadline is not None:
+            deadline.check(f"Query of {collection_name}")
+        collection = self.chroma_client.get_collection(collection_name)
+        check_collection_config(collection, self.embedding_config)
+        return collection.query(
+            query_embeddings=query_embeddings, n_results=n_results, where=where
         )
-        self.collection = self.chroma_client.get_or_create_collection(
-            "news_articles", embedding_function=self.openai_ef
+
+    def query_news(self, query_text, n_results=5, start=None, end=None):
+        """Search the weekly partitions a time window touches and merge the top hits."""
+        names = partitions_in_window(self.partitions, start, end)
+        if not names:
+            return {
+                "ids": [[]],
+                "documents": [[]],
+                "metadatas": [[]],
+                "distances": [[]],
+            }
+
+        conditions = []
+        if start is not None:
+            conditions.append({"published_at": {"$gte": int(start.timestamp())}})
+        if end is not None:
+            conditions.append({"published_at": {"$lte": int(end.timestamp())}})
+        where = None
+        if len(conditions) == 1:
+            where = conditions[0]
+        elif conditions:
+            where = {"$and": conditions}
+
+        # Embed once and search every partition in parallel. The deadline is
+        # passed explicitly since context variables don't follow into the pool.
+        deadline = current_deadline()
+        query_embeddings = self.openai_ef([query_text])
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            partition_results = list(
+                executor.map(
+                    lambda name: self.query_partition(
+                        name, query_embeddings, n_results, where, deadline
+                    ),
+                    names,
+                )
+            )
+        return merge_query_results(partition_results, n_results)
+
+
+def merge_query_results(partition_results, n_results):
+    """Merge single-query results from several collections by distance."""
+    hits = []
+    for results in partition_results:
+        hits.extend(
+            zip(
+                results["distances"][0],
+                results["ids"][0],
+                results["documents"][0],
+                results["metadatas"][0],
+            )
         )
+    hits = sorted(hits, key=lambda hit: hit[0])[:n_results]
+    return {
+        "ids": [[hit[1] for hit in hits]],
+        "documents": [[hit[2] for hit in hits]],
+        "metadatas": [[hit[3] for hit in hits]],
+        "distances": [[hit[0] for hit in hits]],
+    }
+
 
-    def query_news(self, query_text, n_results=5):
-        results = self.collection.query(query_texts=[query_text], n_results=n_results)
-        return results
+def parse_date_bound(value, end_of_day=False):
+    bound = parse_published_at(value)
+    # A bare date as the end of a window includes that whole day
+    if bound is not None and end_of_day and len(value) == len("YYYY-MM-DD"):
+        bound += timedelta(days=1) - timedelta(microseconds=1)
+    return bound
 
 
-def query_tech_news(query: str, num_results: int = 5) -> str:
+def query_tech_news(
+    query: str,
+    num_results: int = 5,
+    start_date: str = None,
+    end_date: str = None,
+) -> str:
     news_db = ChromaNewsDatabase()
-    results = news_db.query_news(query, n_results=num_results)
+    results = news_db.query_news(
+        query,
+        n_results=num_results,
+        start=parse_date_bound(start_date),
+        end=parse_date_bound(end_date, end_of_day=True),
+    )
 
     # Format the results as a JSON string
     formatted_results = []
@@ -0,0 +1,64 @@
+import contextvars
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when work runs past the latency budget of its turn."""
+
+
+class Deadline:
+    """A fixed point in time by which a unit of work has to finish."""
+
+    def __init__(self, budget_seconds: float):
+        self.budget_seconds = budget_seconds
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + budget_seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def check(self, what: str = "Operation"):
+        if self.expired:
+            raise DeadlineExceeded(
+                f"{what} exceeded its {self.budget_seconds}s latency budget"
+            )
+
+
+_current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current_deadline.get()
+
+
+@contextmanager
+def deadline_scope(deadline: Deadline):
+    """Make `deadline` visible to everything called within the block.
+
+    Work handed to other threads has to carry it over with
+    contextvars.copy_context().
+    """
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def remaining_time(default: Optional[float] = None) -> Optional[float]:
+    """Seconds left on the current deadline, capped at `default` if given."""
+    deadline = current_deadline()
+    if deadline is None:
+        return default
+    if default is None:
+        return deadline.remaining()
+    return min(default, deadline.remaining())
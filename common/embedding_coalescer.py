@@ -0,0 +1,132 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from functools import lru_cache
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from common.deadline import (
+    DeadlineExceeded,
+    current_deadline,
+    deadline_scope,
+    remaining_time,
+)
+from common.embedding_config import EmbeddingConfig
+
+
+class EmbeddingCoalescer(EmbeddingFunction[Documents]):
+    """Batch embedding requests from concurrent callers into single calls.
+
+    Texts submitted within `max_wait_ms` of the first one in a batch, up to
+    `max_batch_size`, are embedded together by a background thread. Each
+    caller blocks only on the futures for its own texts, and no longer than
+    its current deadline allows. The batch request itself runs under the
+    latest deadline of the callers in it, or none if any caller has none.
+    """
+
+    def __init__(
+        self,
+        embedding_function,
+        max_batch_size: int = 64,
+        max_wait_ms: float = 5.0,
+    ):
+        self.embedding_function = embedding_function
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.metrics_lock = threading.Lock()
+        self.batch_count = 0
+        self.text_count = 0
+        self.last_batch_size = 0
+        self.largest_batch_size = 0
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def __call__(self, input: Documents) -> Embeddings:
+        futures = [self.submit(text) for text in input]
+        try:
+            return [future.result(timeout=remaining_time()) for future in futures]
+        except TimeoutError:
+            raise DeadlineExceeded("Query embedding exceeded its latency budget")
+
+    def submit(self, text: str) -> Future:
+        future = Future()
+        self.queue.put((text, future, current_deadline()))
+        return future
+
+    def metrics(self) -> dict:
+        with self.metrics_lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "batches": self.batch_count,
+                "texts": self.text_count,
+                "last_batch_size": self.last_batch_size,
+                "largest_batch_size": self.largest_batch_size,
+                "mean_batch_size": (
+                    self.text_count / self.batch_count if self.batch_count else 0
+                ),
+            }
+
+    def _next_batch(self) -> list:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            with self.metrics_lock:
+                self.batch_count += 1
+                self.text_count += len(batch)
+                self.last_batch_size = len(batch)
+                self.largest_batch_size = max(self.largest_batch_size, len(batch))
+            live = []
+            for text, future, deadline in batch:
+                if deadline is not None and deadline.expired:
+                    future.set_exception(
+                        DeadlineExceeded("Query embedding exceeded its latency budget")
+                    )
+                else:
+                    live.append((text, future, deadline))
+            if not live:
+                continue
+            # The request lasts as long as the caller with the most time left
+            # needs it. Callers with less stop waiting on their own futures.
+            deadlines = [deadline for _, _, deadline in live]
+            if None in deadlines:
+                self._embed(live)
+            else:
+                with deadline_scope(max(deadlines, key=lambda d: d.expires_at)):
+                    self._embed(live)
+
+    def _embed(self, batch: list):
+        try:
+            vectors = self.embedding_function([text for text, _, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # Retry one at a time so a bad input only fails its own caller
+            for text, future, _ in batch:
+                try:
+                    future.set_result(self.embedding_function([text])[0])
+                except Exception as e:
+                    future.set_exception(e)
+            return
+        for (_, future, _), vector in zip(batch, vectors):
+            future.set_result(vector)
+
+
+@lru_cache(maxsize=None)
+def get_coalesced_embedding_function(
+    config: EmbeddingConfig, api_key: str
+) -> EmbeddingCoalescer:
+    """Return the process-wide coalescer for an embedding config."""
+    return EmbeddingCoalescer(config.embedding_function(api_key))
@@ -0,0 +1,84 @@
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+DEFAULT_EMBEDDING_MODEL_NAME = "text-embedding-ada-002"
+OPENAI_BACKEND = "openai"
+# Runs a sentence-transformers model on the local CPU, no API calls
+LOCAL_BACKEND = "local"
+DEFAULT_LOCAL_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Collection metadata keys recording how the stored vectors were produced
+MODEL_METADATA_KEY = "embedding_model"
+DIMENSIONS_METADATA_KEY = "embedding_dimensions"
+BACKEND_METADATA_KEY = "embedding_backend"
+
+
+class EmbeddingConfigMismatch(ValueError):
+    """Raised when a collection was embedded with a different model or size."""
+
+
+@dataclass(frozen=True)
+class EmbeddingConfig:
+    model_name: str = DEFAULT_EMBEDDING_MODEL_NAME
+    # Only the text-embedding-3 and Matryoshka-trained local models accept a
+    # reduced size; None keeps the model's native dimensions
+    dimensions: Optional[int] = None
+    backend: str = OPENAI_BACKEND
+
+    def collection_metadata(self) -> dict:
+        metadata = {
+            MODEL_METADATA_KEY: self.model_name,
+            BACKEND_METADATA_KEY: self.backend,
+        }
+        if self.dimensions:
+            metadata[DIMENSIONS_METADATA_KEY] = self.dimensions
+        return metadata
+
+    @classmethod
+    def from_collection_metadata(cls, metadata: Optional[dict]) -> "EmbeddingConfig":
+        # Collections created before the config was recorded were all
+        # embedded with the default model
+        metadata = metadata or {}
+        return cls(
+            model_name=metadata.get(MODEL_METADATA_KEY, DEFAULT_EMBEDDING_MODEL_NAME),
+            dimensions=metadata.get(DIMENSIONS_METADATA_KEY),
+            backend=metadata.get(BACKEND_METADATA_KEY, OPENAI_BACKEND),
+        )
+
+    def embedding_function(self, api_key: str):
+        if self.backend == LOCAL_BACKEND:
+            from common.local_embeddings import get_local_embedding_function
+
+            return get_local_embedding_function(self.model_name, self.dimensions)
+        from common.openai_embeddings import OpenAIEmbeddingFunction
+
+        return OpenAIEmbeddingFunction(api_key, self.model_name, self.dimensions)
+
+
+def load_embedding_config() -> EmbeddingConfig:
+    """Read the embedding backend, model and dimensions from the environment."""
+    dimensions = os.getenv("EMBEDDING_DIMENSIONS")
+    backend = os.getenv("EMBEDDING_BACKEND", OPENAI_BACKEND)
+    if backend not in (OPENAI_BACKEND, LOCAL_BACKEND):
+        raise ValueError(f"Unknown embedding backend: {backend}")
+    default_model_name = (
+        DEFAULT_LOCAL_MODEL_NAME
+        if backend == LOCAL_BACKEND
+        else DEFAULT_EMBEDDING_MODEL_NAME
+    )
+    return EmbeddingConfig(
+        model_name=os.getenv("EMBEDDING_MODEL_NAME", default_model_name),
+        dimensions=int(dimensions) if dimensions else None,
+        backend=backend,
+    )
+
+
+def check_collection_config(collection, config: EmbeddingConfig):
+    """Refuse to use a collection whose vectors came from a different config."""
+    stored = EmbeddingConfig.from_collection_metadata(collection.metadata)
+    if stored != config:
+        raise EmbeddingConfigMismatch(
+            f"Collection {collection.name!r} was embedded with {stored}, "
+            f"not {config}"
+        )
@@ -0,0 +1,84 @@
+import os
+import threading
+from functools import lru_cache
+from typing import Optional
+import numpy as np
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from common.embedding_config import DEFAULT_LOCAL_MODEL_NAME
+
+
+class LocalEmbeddingFunction(EmbeddingFunction[Documents]):
+    """Embed documents on the local CPU with a sentence-transformers model.
+
+    Small inputs (a single query) are encoded in-process for low latency.
+    Inputs of at least `bulk_threshold` documents are spread over a pool of
+    worker processes, which is started the first time it is needed.
+    """
+
+    def __init__(
+        self,
+        model_name: str = DEFAULT_LOCAL_MODEL_NAME,
+        dimensions: Optional[int] = None,
+        backend: str = "torch",
+        batch_size: int = 64,
+        num_workers: Optional[int] = None,
+        bulk_threshold: int = 256,
+    ):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ValueError(
+                "The sentence_transformers python package is not installed. "
+                "Please install it with `pip install sentence_transformers`"
+            )
+        # backend="onnx" runs the model through onnxruntime instead of torch
+        self.model = SentenceTransformer(
+            model_name, device="cpu", backend=backend, truncate_dim=dimensions
+        )
+        self.batch_size = batch_size
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.bulk_threshold = bulk_threshold
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def __call__(self, input: Documents) -> Embeddings:
+        if len(input) >= self.bulk_threshold and self.num_workers > 1:
+            vectors = self.model.encode_multi_process(
+                list(input),
+                self._get_pool(),
+                batch_size=self.batch_size,
+                normalize_embeddings=True,
+            )
+        else:
+            # sentence-transformers sorts the input by length before batching,
+            # so each batch is padded only as far as its own longest document
+            vectors = self.model.encode(
+                list(input),
+                batch_size=self.batch_size,
+                normalize_embeddings=True,
+                convert_to_numpy=True,
+            )
+        return np.asarray(vectors, dtype=np.float32).tolist()
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = self.model.start_multi_process_pool(
+                    ["cpu"] * self.num_workers
+                )
+            return self._pool
+
+    def close(self):
+        """Stop the worker processes used for bulk encoding, if any."""
+        with self._pool_lock:
+            if self._pool is not None:
+                self.model.stop_multi_process_pool(self._pool)
+                self._pool = None
+
+
+@lru_cache(maxsize=None)
+def get_local_embedding_function(
+    model_name: str, dimensions: Optional[int] = None
+) -> LocalEmbeddingFunction:
+    """Return a process-wide instance so the model is loaded only once."""
+    return LocalEmbeddingFunction(model_name, dimensions)
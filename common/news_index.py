@@ -0,0 +1,186 @@
+import json
+import os
+import re
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional
+from common.embedding_config import EmbeddingConfig, check_collection_config
+
+NEWS_COLLECTION_ALIAS = "news_articles"
+ALIASES_FILE_NAME = "collection_aliases.json"
+
+# Articles are split into one collection per ISO week of publishedAt, named
+# "<base>.<year>w<week>". Articles without a date stay in "<base>" itself.
+PARTITION_LABEL_PATTERN = re.compile(r"\d{4}w\d{2}")
+
+
+def aliases_path(chroma_db_path: str) -> str:
+    return os.path.join(chroma_db_path, ALIASES_FILE_NAME)
+
+
+def read_aliases(chroma_db_path: str) -> dict:
+    try:
+        with open(aliases_path(chroma_db_path)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def resolve_collection_name(
+    chroma_db_path: str, alias: str = NEWS_COLLECTION_ALIAS
+) -> str:
+    """Return the collection an alias points at, or the alias itself if unset."""
+    return read_aliases(chroma_db_path).get(alias, alias)
+
+
+def switch_alias(chroma_db_path: str, alias: str, collection_name: str):
+    """Atomically point an alias at a collection.
+
+    The aliases file is replaced with os.replace, so concurrent readers see
+    either the old or the new target and never a partial write.
+    """
+    aliases = read_aliases(chroma_db_path)
+    aliases[alias] = collection_name
+    os.makedirs(chroma_db_path, exist_ok=True)
+    tmp_path = f"{aliases_path(chroma_db_path)}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(aliases, f)
+    os.replace(tmp_path, aliases_path(chroma_db_path))
+
+
+def collection_names(chroma_client) -> list:
+    # Newer Chroma versions return names instead of collection objects
+    return [
+        collection if isinstance(collection, str) else collection.name
+        for collection in chroma_client.list_collections()
+    ]
+
+
+def open_collection(
+    chroma_client,
+    collection_name: str,
+    config: EmbeddingConfig,
+    api_key: str,
+):
+    """Get or create a collection, refusing one embedded with another config."""
+    embedding_function = config.embedding_function(api_key)
+    # Chroma raises a different exception type for a missing collection
+    # depending on the version, so look the name up instead of catching it
+    if collection_name not in collection_names(chroma_client):
+        return chroma_client.create_collection(
+            collection_name,
+            embedding_function=embedding_function,
+            metadata=config.collection_metadata(),
+        )
+    collection = chroma_client.get_collection(
+        collection_name, embedding_function=embedding_function
+    )
+    check_collection_config(collection, config)
+    return collection
+
+
+def parse_published_at(value: Optional[str]) -> Optional[datetime]:
+    """Parse a NewsAPI publishedAt timestamp such as 2024-06-01T12:00:00Z."""
+    if not value:
+        return None
+    published_at = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if published_at.tzinfo is None:
+        published_at = published_at.replace(tzinfo=timezone.utc)
+    return published_at
+
+
+def partition_label(published_at: Optional[datetime]) -> Optional[str]:
+    if published_at is None:
+        return None
+    year, week, _ = published_at.isocalendar()
+    return f"{year}w{week:02d}"
+
+
+def partition_bounds(label: str) -> tuple:
+    """Return the [start, end) datetimes covered by a weekly partition."""
+    year, week = label.split("w")
+    start = datetime.combine(
+        date.fromisocalendar(int(year), int(week), 1),
+        datetime.min.time(),
+        tzinfo=timezone.utc,
+    )
+    return start, start + timedelta(weeks=1)
+
+
+def partition_collection_name(base_name: str, label: Optional[str]) -> str:
+    return base_name if label is None else f"{base_name}.{label}"
+
+
+def open_partition(
+    chroma_client,
+    base_name: str,
+    label: Optional[str],
+    config: EmbeddingConfig,
+    api_key: str,
+):
+    """Get or create a partition of a base, keeping the base on one config.
+
+    A new week is only created if the base's existing partitions were
+    embedded with the same config, so queries can embed once for all of them.
+    """
+    collection_name = partition_collection_name(base_name, label)
+    partitions = list_partitions(chroma_client, base_name)
+    if collection_name not in partitions.values() and partitions:
+        existing = chroma_client.get_collection(
+            next(iter(partitions.values())),
+            embedding_function=config.embedding_function(api_key),
+        )
+        check_collection_config(existing, config)
+    return open_collection(chroma_client, collection_name, config, api_key)
+
+
+def list_partitions(chroma_client, base_name: str) -> dict:
+    """Map partition label to collection name for every partition of a base.
+
+    The unpartitioned base collection, if it exists, is keyed by None.
+    """
+    partitions = {}
+    for name in collection_names(chroma_client):
+        if name == base_name:
+            partitions[None] = name
+        elif name.startswith(f"{base_name}."):
+            label = name[len(base_name) + 1 :]
+            if PARTITION_LABEL_PATTERN.fullmatch(label):
+                partitions[label] = name
+    return partitions
+
+
+def partitions_in_window(
+    partitions: dict,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+) -> list:
+    """Return the collections a [start, end] time window touches.
+
+    Without a window every collection is searched. With one, the
+    unpartitioned collection is skipped since its articles have no date.
+    """
+    if start is None and end is None:
+        return list(partitions.values())
+    names = []
+    for label, name in partitions.items():
+        if label is None:
+            continue
+        partition_start, partition_end = partition_bounds(label)
+        if start is not None and partition_end <= start:
+            continue
+        if end is not None and partition_start > end:
+            continue
+        names.append(name)
+    return names
+
+
+def expired_partitions(
+    partitions: dict, retention_weeks: int, now: Optional[datetime] = None
+) -> list:
+    """Return the collections whose whole week is older than the retention."""
+    cutoff = (now or datetime.now(timezone.utc)) - timedelta(weeks=retention_weeks)
+    return [
+        name
+        for label, name in partitions.items()
+        if label is not None and partition_bounds(label)[1] <= cutoff
+    ]
@@ -0,0 +1,41 @@
+import os
+from functools import lru_cache
+from typing import Optional
+import httpx
+from openai import DefaultHttpxClient, OpenAI
+from common.rate_limiter import rate_limit_request_hook, rate_limit_response_hook
+
+# One pool is shared by the Assistants API and embedding calls, so connections
+# (and their TLS sessions) are reused across tool calls and batches
+HTTP_POOL_LIMITS = httpx.Limits(
+    max_connections=100, max_keepalive_connections=20, keepalive_expiry=120
+)
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+
+
+@lru_cache(maxsize=None)
+def get_http_client() -> httpx.Client:
+    """Return the process-wide keep-alive HTTP/2 client.
+
+    Every request waits on the shared rate limiter before it is sent, and
+    every response feeds its rate limit headers back into it.
+    """
+    return DefaultHttpxClient(
+        http2=True,
+        limits=HTTP_POOL_LIMITS,
+        timeout=HTTP_TIMEOUT,
+        event_hooks={
+            "request": [rate_limit_request_hook],
+            "response": [rate_limit_response_hook],
+        },
+    )
+
+
+@lru_cache(maxsize=None)
+def _openai_client(api_key: str) -> OpenAI:
+    return OpenAI(api_key=api_key, http_client=get_http_client())
+
+
+def get_openai_client(api_key: Optional[str] = None) -> OpenAI:
+    """Return an OpenAI client backed by the shared connection pool."""
+    return _openai_client(api_key or os.getenv("OPENAI_API_KEY"))
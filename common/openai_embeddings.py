@@ -0,0 +1,39 @@
+from typing import Optional
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from common.deadline import remaining_time
+from common.openai_clients import get_openai_client
+
+
+class OpenAIEmbeddingFunction(EmbeddingFunction[Documents]):
+    """Chroma embedding function that calls OpenAI over the shared client.
+
+    Chroma's own OpenAIEmbeddingFunction builds a new OpenAI client (and
+    connection pool) per instance; this one reuses the process-wide pool.
+    """
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        model_name: str = "text-embedding-ada-002",
+        dimensions: Optional[int] = None,
+    ):
+        self.client = get_openai_client(api_key)
+        # Retries would each get the full remaining time, so requests made
+        # under a deadline are sent once
+        self.deadline_client = self.client.with_options(max_retries=0)
+        self.model_name = model_name
+        self.dimensions = dimensions
+
+    def __call__(self, input: Documents) -> Embeddings:
+        # Newlines degrade ada-002 embeddings
+        input = [text.replace("\n", " ") for text in input]
+        kwargs = {"model": self.model_name, "input": input}
+        if self.dimensions:
+            kwargs["dimensions"] = self.dimensions
+        client = self.client
+        timeout = remaining_time()
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+            client = self.deadline_client
+        response = client.embeddings.create(**kwargs)
+        return [data.embedding for data in sorted(response.data, key=lambda d: d.index)]
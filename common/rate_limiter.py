@@ -0,0 +1,229 @@
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Optional
+import httpx
+from common.deadline import remaining_time
+
+DEFAULT_RATE_LIMIT_DB_PATH = os.path.join(
+    tempfile.gettempdir(), "openai_rate_limits.db"
+)
+# Used until the first response tells us the real limits for a model
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 1_000_000
+# Lowest limit a bucket refills at. A limit of zero reported for a model
+# would otherwise never refill and divide by zero when computing the wait.
+MIN_PER_MINUTE = 1
+# Assistants API calls don't name a model in the request body
+ASSISTANTS_RATE_LIMIT_KEY = "assistants"
+
+
+class RateLimitWaitTooLong(Exception):
+    """Raised when waiting for capacity would outlast the caller's deadline."""
+
+
+def parse_reset_duration(value: str) -> float:
+    """Parse an x-ratelimit-reset-* value such as "1s", "6m0s" or "20ms"."""
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(
+        float(amount) * units[unit]
+        for amount, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    )
+
+
+class RateLimiter:
+    """Token buckets for requests and tokens per model, shared across processes.
+
+    Bucket state lives in a local SQLite file and every update runs in an
+    exclusive transaction, so all processes on the machine draw from the
+    same buckets. Limits and remaining capacity are corrected from the
+    x-ratelimit-* headers of each response.
+    """
+
+    def __init__(self, path: str = DEFAULT_RATE_LIMIT_DB_PATH):
+        self.path = path
+        with self._transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    requests_per_minute REAL NOT NULL,
+                    tokens_per_minute REAL NOT NULL,
+                    requests REAL NOT NULL,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """)
+
+    @contextmanager
+    def _transaction(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            # Take the write lock up front so read-refill-write is atomic
+            # across processes
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+    def _refilled_bucket(self, conn, key: str, now: float) -> list:
+        row = conn.execute(
+            "SELECT requests_per_minute, tokens_per_minute, requests, tokens, "
+            "updated_at FROM buckets WHERE key = ?",
+            (key,),
+        ).fetchone()
+        if row is None:
+            return [
+                DEFAULT_REQUESTS_PER_MINUTE,
+                DEFAULT_TOKENS_PER_MINUTE,
+                DEFAULT_REQUESTS_PER_MINUTE,
+                DEFAULT_TOKENS_PER_MINUTE,
+            ]
+        rpm, tpm, requests, tokens, updated_at = row
+        rpm, tpm = max(rpm, MIN_PER_MINUTE), max(tpm, MIN_PER_MINUTE)
+        elapsed_minutes = max(0.0, now - updated_at) / 60
+        return [
+            rpm,
+            tpm,
+            min(rpm, requests + elapsed_minutes * rpm),
+            min(tpm, tokens + elapsed_minutes * tpm),
+        ]
+
+    def _save_bucket(self, conn, key: str, bucket: list, now: float):
+        conn.execute(
+            "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?, ?)",
+            (key, *bucket, now),
+        )
+
+    def acquire(self, key: str, tokens: int = 0, max_wait: Optional[float] = None):
+        """Block until one request and `tokens` tokens are available for `key`.
+
+        Raises RateLimitWaitTooLong instead of waiting past `max_wait` seconds.
+        """
+        started_at = time.monotonic()
+        while True:
+            now = time.time()
+            with self._transaction() as conn:
+                rpm, tpm, available_requests, available_tokens = self._refilled_bucket(
+                    conn, key, now
+                )
+                # A single request can never need more than a full bucket
+                needed_tokens = min(tokens, tpm)
+                if available_requests >= 1 and available_tokens >= needed_tokens:
+                    self._save_bucket(
+                        conn,
+                        key,
+                        [
+                            rpm,
+                            tpm,
+                            available_requests - 1,
+                            available_tokens - needed_tokens,
+                        ],
+                        now,
+                    )
+                    return
+                self._save_bucket(
+                    conn, key, [rpm, tpm, available_requests, available_tokens], now
+                )
+            wait = max(
+                (1 - available_requests) * 60 / rpm,
+                (needed_tokens - available_tokens) * 60 / tpm,
+            )
+            if max_wait is not None and time.monotonic() - started_at + wait > max_wait:
+                raise RateLimitWaitTooLong(
+                    f"Waiting {wait:.2f}s for {key} capacity would exceed {max_wait:.2f}s"
+                )
+            time.sleep(wait)
+
+    def update_from_headers(self, key: str, headers):
+        """Adopt the limits and remaining capacity reported by the API."""
+        limit_requests = headers.get("x-ratelimit-limit-requests")
+        limit_tokens = headers.get("x-ratelimit-limit-tokens")
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if not any(
+            [limit_requests, limit_tokens, remaining_requests, remaining_tokens]
+        ):
+            return
+        now = time.time()
+        with self._transaction() as conn:
+            rpm, tpm, requests, tokens = self._refilled_bucket(conn, key, now)
+            if limit_requests:
+                rpm = max(float(limit_requests), MIN_PER_MINUTE)
+            if limit_tokens:
+                tpm = max(float(limit_tokens), MIN_PER_MINUTE)
+            # Other machines share the quota, so the server's count wins when
+            # it is lower than ours
+            if remaining_requests:
+                requests = min(requests, float(remaining_requests))
+            if remaining_tokens:
+                tokens = min(tokens, float(remaining_tokens))
+            self._save_bucket(
+                conn, key, [rpm, tpm, min(requests, rpm), min(tokens, tpm)], now
+            )
+
+    def back_off(self, key: str, seconds: float):
+        """Empty the request bucket so every process waits `seconds` after a 429."""
+        now = time.time()
+        with self._transaction() as conn:
+            rpm, tpm, _, tokens = self._refilled_bucket(conn, key, now)
+            # A negative balance takes `seconds` to refill back to one request
+            self._save_bucket(
+                conn, key, [rpm, tpm, 1 - seconds * rpm / 60, tokens], now
+            )
+
+
+@lru_cache(maxsize=None)
+def get_rate_limiter() -> RateLimiter:
+    return RateLimiter(os.getenv("OPENAI_RATE_LIMIT_DB", DEFAULT_RATE_LIMIT_DB_PATH))
+
+
+def estimate_request(request: httpx.Request) -> tuple:
+    """Return the rate limit key and estimated token cost of a request."""
+    try:
+        body = json.loads(request.content or b"{}")
+    except (ValueError, UnicodeDecodeError, httpx.RequestNotRead):
+        # Streamed uploads and non-JSON bodies are only counted as requests
+        body = {}
+    if not isinstance(body, dict) or "model" not in body:
+        return ASSISTANTS_RATE_LIMIT_KEY, 0
+    texts = body.get("input", [])
+    if isinstance(texts, str):
+        texts = [texts]
+    # Roughly four characters per token for English text
+    tokens = sum(len(text) for text in texts if isinstance(text, str)) // 4
+    return body["model"], tokens
+
+
+def rate_limit_request_hook(request: httpx.Request):
+    key, tokens = estimate_request(request)
+    request.extensions["rate_limit_key"] = key
+    try:
+        get_rate_limiter().acquire(key, tokens, max_wait=remaining_time())
+    except RateLimitWaitTooLong as e:
+        # Surfaces from the OpenAI client as an APITimeoutError
+        raise httpx.PoolTimeout(str(e), request=request)
+
+
+def rate_limit_response_hook(response: httpx.Response):
+    key = response.request.extensions.get("rate_limit_key")
+    if key is None:
+        return
+    limiter = get_rate_limiter()
+    limiter.update_from_headers(key, response.headers)
+    if response.status_code == 429:
+        retry_after = response.headers.get("retry-after")
+        reset = response.headers.get("x-ratelimit-reset-requests")
+        if retry_after and retry_after.replace(".", "", 1).isdigit():
+            limiter.back_off(key, float(retry_after))
+        elif reset:
+            limiter.back_off(key, parse_reset_duration(reset))
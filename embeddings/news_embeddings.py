@@ -1,11 +1,75 @@
 import os
-import pandas as pd
+import sys
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+import numpy as np
+import pyarrow as pa
 from dotenv import load_dotenv
 from newsapi import NewsApiClient
 import chromadb
-import chromadb.utils.embedding_functions as embedding_functions
 from prefect import task, flow
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.embedding_config import (
+    OPENAI_BACKEND,
+    EmbeddingConfig,
+    load_embedding_config,
+)
+from common.news_index import (
+    open_partition,
+    parse_published_at,
+    partition_label,
+    resolve_collection_name,
+)
+
+ARTICLE_SCHEMA = pa.schema(
+    [
+        ("title", pa.string()),
+        ("description", pa.string()),
+        ("author", pa.string()),
+        ("url", pa.string()),
+        ("urlToImage", pa.string()),
+        ("publishedAt", pa.string()),
+        ("content", pa.string()),
+    ]
+)
+EMBEDDING_BATCH_SIZE = 256
+
+
+def write_arrow_file(batches, schema: pa.Schema, staging_dir: str) -> str:
+    """Write record batches to an Arrow IPC file and return its path.
+
+    Tasks hand each other file paths instead of DataFrames, so Prefect only
+    persists a short string as the task result.
+    """
+    os.makedirs(staging_dir, exist_ok=True)
+    path = os.path.join(staging_dir, f"{uuid.uuid4().hex}.arrow")
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+    return path
+
+
+@contextmanager
+def open_arrow_file(path: str):
+    """Yield the table in an Arrow IPC file, read through a memory map.
+
+    The map is closed when the block exits, so consumers should finish with
+    the table inside it.
+    """
+    with pa.memory_map(path, "r") as source:
+        yield pa.ipc.open_file(source).read_all()
+
+
+@task
+def remove_staged_files(paths: list):
+    """Delete staging files once their articles are stored."""
+    for path in set(paths):
+        if os.path.exists(path):
+            os.remove(path)
+
 
 @task
 def load_environment_variables():
@@ -19,8 +83,10 @@ def load_environment_variables():
 
 
 @task
-def fetch_news_articles(api_key: str, query: str, num_articles: int) -> pd.DataFrame:
-    """Fetch news articles using the NewsAPI client."""
+def fetch_news_articles(
+    api_key: str, query: str, num_articles: int, staging_dir: str
+) -> str:
+    """Fetch news articles using the NewsAPI client into an Arrow file."""
     newsapi = NewsApiClient(api_key=api_key)
     articles = newsapi.get_everything(q=query, language="en", page_size=num_articles)
     data = [
@@ -35,35 +101,123 @@ def fetch_news_articles(api_key: str, query: str, num_articles: int) -> pd.DataF
         }
         for article in articles["articles"]
     ]
-    return pd.DataFrame(data)
+    seen_urls = set()
+    unique = []
+    for row in data:
+        if row["url"] not in seen_urls:
+            seen_urls.add(row["url"])
+            unique.append(row)
+    batch = pa.RecordBatch.from_pylist(unique, schema=ARTICLE_SCHEMA)
+    return write_arrow_file([batch], ARTICLE_SCHEMA, staging_dir)
+
+
+@task
+def embed_articles(
+    articles_path: str,
+    openai_api_key: str,
+    embedding_model_name: str,
+    embedding_dimensions: Optional[int],
+    embedding_backend: str,
+    staging_dir: str,
+) -> str:
+    """Precompute content embeddings as a fixed-size float32 list column."""
+    config = EmbeddingConfig(
+        embedding_model_name, embedding_dimensions, embedding_backend
+    )
+    openai_ef = config.embedding_function(openai_api_key)
+    with open_arrow_file(articles_path) as table:
+        batches = []
+        for batch in table.to_batches(max_chunksize=EMBEDDING_BATCH_SIZE):
+            documents = batch.column("content").to_pylist()
+            vectors = np.asarray(openai_ef(documents), dtype=np.float32)
+            embeddings = pa.FixedSizeListArray.from_arrays(
+                pa.array(vectors.ravel()), vectors.shape[1]
+            )
+            batches.append(batch.append_column("embedding", embeddings))
+        if not batches:
+            return articles_path
+        return write_arrow_file(batches, batches[0].schema, staging_dir)
 
 
 @task
 def store_embeddings_in_chroma(
-    df: pd.DataFrame,
+    articles_path: str,
     openai_api_key: str,
     chroma_db_path: str,
     embedding_model_name: str,
+    embedding_dimensions: Optional[int] = None,
+    embedding_backend: str = OPENAI_BACKEND,
 ):
-    """Store embeddings of news article titles and content in a ChromaDB collection."""
+    """Store embeddings of news articles in weekly ChromaDB collections.
+
+    Each article goes into the partition for the ISO week it was published in,
+    so old weeks can later be dropped as whole collections.
+    """
     chroma_client = chromadb.PersistentClient(path=chroma_db_path)
-    openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-        api_key=openai_api_key, model_name=embedding_model_name
+    config = EmbeddingConfig(
+        embedding_model_name, embedding_dimensions, embedding_backend
     )
-    collection = chroma_client.get_or_create_collection(
-        "news_articles", embedding_function=openai_ef
-    )
-    df = df.drop_duplicates(subset=["url"])
-    documents = df["content"].tolist()
-    metadata = [
-        {"title": title, "url": url} for title, url in zip(df["title"], df["url"])
+    base_name = resolve_collection_name(chroma_db_path)
+    collections = {}
+    with open_arrow_file(articles_path) as table:
+        for batch in table.to_batches():
+            published = [
+                parse_published_at(value)
+                for value in batch.column("publishedAt").to_pylist()
+            ]
+            labels = [partition_label(published_at) for published_at in published]
+            # NewsAPI returns articles sorted by date, so rows of the same week are
+            # contiguous and each run can be added as a zero-copy slice
+            start = 0
+            for end in range(1, len(labels) + 1):
+                if end < len(labels) and labels[end] == labels[start]:
+                    continue
+                label = labels[start]
+                if label not in collections:
+                    collections[label] = open_partition(
+                        chroma_client, base_name, label, config, openai_api_key
+                    )
+                add_articles(
+                    collections[label],
+                    batch.slice(start, end - start),
+                    published[start:end],
+                )
+                start = end
+    for collection in collections.values():
+        print(f"------------------- {collection.name} -------------------")
+        print(collection.peek(1))
+        print(collection.count())
+
+
+def add_articles(collection, batch: pa.RecordBatch, published: list):
+    """Add a batch of articles, with precomputed embeddings if it has them."""
+    documents = batch.column("content").to_pylist()
+    metadata = []
+    for title, url, published_at in zip(
+        batch.column("title").to_pylist(), batch.column("url").to_pylist(), published
+    ):
+        article_metadata = {"title": title, "url": url}
+        if published_at is not None:
+            article_metadata["published_at"] = int(published_at.timestamp())
+        metadata.append(article_metadata)
+    # IDs derived from the URL keep re-ingested articles from piling up
+    ids = [
+        str(uuid.uuid5(uuid.NAMESPACE_URL, url))
+        for url in batch.column("url").to_pylist()
     ]
-    ids = [f"id{i}" for i in range(len(df))]
-    collection.add(documents=documents, metadatas=metadata, ids=ids)
-    print("------------------- peek -------------------")
-    print(collection.peek(1))
-    print("------------------- count -------------------")
-    print(collection.count())
+    if "embedding" in batch.schema.names:
+        # View the fixed-size list column as a (rows, dims) float32 matrix
+        # backed by the memory-mapped file, so Chroma skips re-embedding
+        embeddings = batch.column("embedding")
+        vectors = embeddings.flatten().to_numpy(zero_copy_only=True)
+        collection.add(
+            documents=documents,
+            metadatas=metadata,
+            ids=ids,
+            embeddings=vectors.reshape(len(embeddings), embeddings.type.list_size),
+        )
+    else:
+        collection.add(documents=documents, metadatas=metadata, ids=ids)
 
 
 @flow
@@ -74,12 +228,37 @@ def news_embedding_pipeline(
     num_articles: int,
     chroma_db_path: str,
     embedding_model_name: str,
+    staging_dir: str = "./staging",
+    precompute_embeddings: bool = True,
+    embedding_dimensions: Optional[int] = None,
+    embedding_backend: str = OPENAI_BACKEND,
 ):
     """Main function to orchestrate fetching news articles and storing embeddings."""
-    news_articles = fetch_news_articles(news_api_key, query_string, num_articles)
+    articles_path = fetch_news_articles(
+        news_api_key, query_string, num_articles, staging_dir
+    )
+    staged_paths = [articles_path]
+    if precompute_embeddings:
+        articles_path = embed_articles(
+            articles_path,
+            openai_api_key,
+            embedding_model_name,
+            embedding_dimensions,
+            embedding_backend,
+            staging_dir,
+        )
+        staged_paths.append(articles_path)
     store_embeddings_in_chroma(
-        news_articles, openai_api_key, chroma_db_path, embedding_model_name
+        articles_path,
+        openai_api_key,
+        chroma_db_path,
+        embedding_model_name,
+        embedding_dimensions,
+        embedding_backend,
     )
+    # Only reached when storing succeeded, so a failed run keeps its files
+    # for a retry
+    remove_staged_files(staged_paths)
 
 
 @flow
@@ -89,11 +268,15 @@ def main():
     QUERY_STRING = "technology"
     NUM_ARTICLES = 60
     CHROMA_DB_PATH = "./chroma_db"
-    EMBEDDING_MODEL_NAME = "text-embedding-ada-002"
+    STAGING_DIR = "./staging"
 
     # Load environment variables
     news_api_key, openai_api_key = load_environment_variables()
 
+    # Embedding model and dimensions come from EMBEDDING_MODEL_NAME and
+    # EMBEDDING_DIMENSIONS so ingestion and queries can't disagree
+    embedding_config = load_embedding_config()
+
     # Run the pipeline
     news_embedding_pipeline(
         news_api_key,
@@ -101,7 +284,10 @@ def main():
         QUERY_STRING,
         NUM_ARTICLES,
         CHROMA_DB_PATH,
-        EMBEDDING_MODEL_NAME,
+        embedding_config.model_name,
+        STAGING_DIR,
+        embedding_dimensions=embedding_config.dimensions,
+        embedding_backend=embedding_config.backend,
     )
 
 
@@ -0,0 +1,148 @@
+import os
+import re
+import sys
+import time
+from typing import Optional
+import chromadb
+from dotenv import load_dotenv
+from prefect import task, flow
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.embedding_config import EmbeddingConfig, load_embedding_config
+from common.news_index import (
+    NEWS_COLLECTION_ALIAS,
+    list_partitions,
+    open_collection,
+    partition_collection_name,
+    resolve_collection_name,
+    switch_alias,
+)
+
+REINDEX_BATCH_SIZE = 256
+# How long after switching the alias to wait for ingestion runs that resolved
+# it before the switch to finish writing to the old collections
+SWITCH_GRACE_SECONDS = 120
+
+
+def reindexed_collection_name(alias: str, config: EmbeddingConfig) -> str:
+    """Name a new collection after the alias, embedding config and time."""
+    # Collection names only allow letters, digits, dots, dashes and underscores
+    # and at most 63 characters, including the weekly partition suffix. Local
+    # model names look like "sentence-transformers/all-MiniLM-L6-v2".
+    model = re.sub(r"[^a-zA-Z0-9._-]", "-", config.model_name.split("/")[-1])[:20]
+    dimensions = config.dimensions or "native"
+    return f"{alias}-{model}-{dimensions}-{int(time.time())}"
+
+
+@task
+def copy_documents(
+    chroma_db_path: str,
+    source_name: str,
+    target_name: str,
+    embedding_model_name: str,
+    embedding_dimensions: Optional[int],
+    embedding_backend: str,
+    openai_api_key: str,
+) -> int:
+    """Re-embed any documents in the source that the target doesn't have yet.
+
+    The stored document text is the cache that is re-embedded, so the news
+    API is never called again. Returns the number of documents copied.
+    """
+    chroma_client = chromadb.PersistentClient(path=chroma_db_path)
+    source = chroma_client.get_collection(source_name)
+    target = open_collection(
+        chroma_client,
+        target_name,
+        EmbeddingConfig(embedding_model_name, embedding_dimensions, embedding_backend),
+        openai_api_key,
+    )
+    existing_ids = set(target.get(include=[])["ids"])
+    copied = 0
+    offset = 0
+    while True:
+        page = source.get(
+            limit=REINDEX_BATCH_SIZE,
+            offset=offset,
+            include=["documents", "metadatas"],
+        )
+        if not page["ids"]:
+            break
+        offset += len(page["ids"])
+        rows = [
+            (article_id, document, metadata)
+            for article_id, document, metadata in zip(
+                page["ids"], page["documents"], page["metadatas"]
+            )
+            if article_id not in existing_ids
+        ]
+        if rows:
+            ids, documents, metadatas = zip(*rows)
+            target.add(
+                ids=list(ids), documents=list(documents), metadatas=list(metadatas)
+            )
+            copied += len(rows)
+    print(f"Copied {copied} documents from {source_name} to {target_name}")
+    return copied
+
+
+@flow
+def reindex_news_collection(
+    chroma_db_path: str = "./chroma_db",
+    alias: str = NEWS_COLLECTION_ALIAS,
+    delete_previous: bool = False,
+    switch_grace_seconds: float = SWITCH_GRACE_SECONDS,
+):
+    """Rebuild the collections behind an alias with the configured embeddings.
+
+    Every weekly partition is copied into a partition of a new base name.
+    Queries keep being served from the current collections while the new ones
+    are built, then the alias is switched over atomically. Documents ingested
+    during the copy are picked up by a catch-up pass before the switch.
+
+    Ingestion runs that resolved the alias before the switch keep writing to
+    the old collections, so they are copied once more `switch_grace_seconds`
+    after it. Anything written to the old collections after that last pass is
+    not carried over; don't run ingestion that outlasts the grace period
+    while reindexing.
+    """
+    load_dotenv()
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+    config = load_embedding_config()
+
+    chroma_client = chromadb.PersistentClient(path=chroma_db_path)
+    source_base = resolve_collection_name(chroma_db_path, alias)
+    target_base = reindexed_collection_name(alias, config)
+    print(f"Reindexing {source_base} into {target_base} with {config}")
+
+    def copy_partitions():
+        partitions = list_partitions(chroma_client, source_base)
+        for label, source_name in partitions.items():
+            copy_documents(
+                chroma_db_path,
+                source_name,
+                partition_collection_name(target_base, label),
+                config.model_name,
+                config.dimensions,
+                config.backend,
+                openai_api_key,
+            )
+        return partitions
+
+    copy_partitions()
+    copy_partitions()
+
+    switch_alias(chroma_db_path, alias, target_base)
+    print(f"Alias {alias} now points at {target_base}")
+
+    time.sleep(switch_grace_seconds)
+    source_partitions = copy_partitions()
+
+    if delete_previous:
+        for source_name in source_partitions.values():
+            chroma_client.delete_collection(source_name)
+            print(f"Deleted {source_name}")
+
+
+if __name__ == "__main__":
+    reindex_news_collection()
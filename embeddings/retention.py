@@ -0,0 +1,37 @@
+import os
+import sys
+import chromadb
+from prefect import flow
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.news_index import (
+    NEWS_COLLECTION_ALIAS,
+    expired_partitions,
+    list_partitions,
+    resolve_collection_name,
+)
+
+
+@flow
+def enforce_news_retention(
+    chroma_db_path: str = "./chroma_db",
+    alias: str = NEWS_COLLECTION_ALIAS,
+    retention_weeks: int = 12,
+):
+    """Drop weekly news partitions older than the retention period.
+
+    Each expired week is removed with a single delete_collection call instead
+    of deleting its documents one by one.
+    """
+    chroma_client = chromadb.PersistentClient(path=chroma_db_path)
+    base_name = resolve_collection_name(chroma_db_path, alias)
+    partitions = list_partitions(chroma_client, base_name)
+    expired = expired_partitions(partitions, retention_weeks)
+    for name in expired:
+        chroma_client.delete_collection(name)
+        print(f"Deleted expired partition {name}")
+    print(f"Kept {len(partitions) - len(expired)} of {len(partitions)} partitions")
+
+
+if __name__ == "__main__":
+    enforce_news_retention()
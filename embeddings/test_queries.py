@@ -1,27 +1,28 @@
 import chromadb
-import chromadb.utils.embedding_functions as embedding_functions
 import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.embedding_config import EmbeddingConfig
+from common.news_index import list_partitions, resolve_collection_name
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-EMBEDDING_MODEL_NAME = "text-embedding-ada-002"
 CHROMA_DB_PATH = "./chroma_db"
 
 chroma_client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
 
-# Define the embedding function using OpenAI
-openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-    api_key=OPENAI_API_KEY, model_name=EMBEDDING_MODEL_NAME
-)
+# Articles are stored in one collection per week of publication
+partitions = list_partitions(chroma_client, resolve_collection_name(CHROMA_DB_PATH))
 
+for collection_name in partitions.values():
+    collection = chroma_client.get_collection(collection_name)
 
-collection = chroma_client.get_or_create_collection(
-    "news_articles", embedding_function=openai_ef
-)
+    # Define the embedding function from the model recorded on the collection
+    embedding_config = EmbeddingConfig.from_collection_metadata(collection.metadata)
+    openai_ef = embedding_config.embedding_function(OPENAI_API_KEY)
 
-results = collection.query(
-    query_texts=[
-        "Show me articles about smartphones"
-    ],  # Chroma will embed this for you
-    n_results=2,  # how many results to return
-)
-print(results)
+    results = collection.query(
+        query_embeddings=openai_ef(["Show me articles about smartphones"]),
+        n_results=2,  # how many results to return
+    )
+    print(collection_name, results)